@@ -23,10 +23,22 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License.
 """
+import hashlib
 import os
-import pwd
+import stat
+import subprocess
 import sys
 import plistlib
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+try:
+    # The system Python on macOS ships with the xattr module. Fall back to
+    # the os module's xattr functions where they exist.
+    import xattr
+except ImportError:
+    xattr = None
 
 
 # Set global constants
@@ -45,6 +57,12 @@ launch_agent_out_path = os.path.join(
     library_logs, launch_agent_label + ".log")
 log_script_file = os.path.join(
     library_support, launch_agent_label + ".py")
+# Extended attribute holding the digest of the script last written.
+log_script_xattr = ("user.primalcurve.sha256")
+# Written after a successful install. Holds the digest of the LaunchAgent and
+# script so that later runs can skip checking either of them.
+install_sentinel = os.path.join(
+    "/var/db", "." + launch_agent_label + ".ok")
 
 # Represent the LaunchAgent as a Python dictionary.
 launch_agent_dict = dict(
@@ -60,61 +78,126 @@ launch_agent_dict = dict(
     StandardErrorPath=launch_agent_out_path
 )
 
-# Get the uid and gid of root (should always be 0 and 0), but it doesn't
-# hurt to have it check every time. We will need this in a couple of places
-# within this script.
-uid = pwd.getpwnam("root").pw_uid
-gid = pwd.getpwnam("root").pw_gid
-
-# Read existing LaunchAgent. LaunchAgents are represented as plists in macOS
-# Therefore we will use plistlib to read it. This will convert the
-# LaunchAgent into a Python dictionary, just like our object above.
-if os.path.exists(launch_agent_file):
-    with open(launch_agent_file, 'rb') as fp:
-        existing_launch_agent = plistlib.readPlist(fp)
-    print("LaunchAgent already exists. Checking it against master LD.")
-else:
-    existing_launch_agent = None
-    print("LaunchAgent does not yet exist. Will create.")
+# The uid and gid of root are always 0 and 0, so they are not looked up in
+# Directory Services. Set JAMF_LOGIN_LOG_DEBUG in the environment to check
+# them against the passwd entry for root. We will need these in a couple of
+# places within this script.
+uid = 0
+gid = 0
+if os.environ.get("JAMF_LOGIN_LOG_DEBUG"):
+    import pwd
+    root_ids = tuple(pwd.getpwnam("root")[2:4])
+    if root_ids != (uid, gid):
+        sys.exit("Unexpected uid and gid for root: %d, %d" % root_ids)
+
+
+def write_file(path, data, mode):
+    # Write data to path with as few write() calls as possible. Both of the
+    # files we write are small enough that this is normally a single call.
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    try:
+        while data:
+            data = data[os.write(fd, data):]
+    finally:
+        os.close(fd)
 
-# If the LaunchAgents do not match, then we will re-write it.
-if existing_launch_agent != launch_agent_dict:
-    # Set existing_launch_agent to New so that if the LaunchAgent is updated,
-    # the old one is properly booted out.
-    existing_launch_agent = "New"
-    print("LaunchAgent does not exist or does not match master. Creating.")
-    # Write the LaunchAgent:
-    with open(launch_agent_file, 'wb') as fp:
-        plistlib.writePlist(launch_agent_dict, fp)
 
-    # Make sure the LaunchAgent has the correct permissions:
-    # Set the ownership.
-    os.lchown(launch_agent_file, uid, gid)
-    # Set permissions:
-    os.chmod(launch_agent_file, 0o644)
+def read_file(path, size):
+    # Return the contents of path in a single read(). If the file does not
+    # exist or is not the expected size, return None without reading it, as
+    # its contents cannot match.
+    try:
+        if os.stat(path).st_size != size:
+            return None
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None
+    try:
+        return os.read(fd, size)
+    finally:
+        os.close(fd)
+
+
+def set_permissions(path, mode):
+    # Make sure a file is owned by root and has the correct mode. Each is only
+    # changed if it is not already correct.
+    st = os.lstat(path)
+    if (st.st_uid, st.st_gid) != (uid, gid):
+        os.lchown(path, uid, gid)
+    if stat.S_IMODE(st.st_mode) != mode:
+        os.chmod(path, mode)
+
+
+def get_xattr(path, name):
+    # Return the value of an extended attribute, or None if the file or the
+    # attribute is missing or xattrs are not supported.
+    try:
+        if xattr is not None:
+            return xattr.getxattr(path, name)
+        return os.getxattr(path, name)
+    except (AttributeError, EnvironmentError, KeyError):
+        return None
+
+
+def set_xattr(path, name, value):
+    # Set an extended attribute. Failures only mean the next run has to
+    # compare the full contents of the file, so they are ignored.
+    try:
+        if xattr is not None:
+            xattr.setxattr(path, name, value)
+        else:
+            os.setxattr(path, name, value)
+    except (AttributeError, EnvironmentError):
+        pass
+
+
+def script_stamp(path, digest):
+    # Return the value stored in the script's xattr: its digest together with
+    # the size and mtime of the file when it was written. An in-place rewrite
+    # keeps the xattr but changes the mtime, so the stamp no longer matches.
+    try:
+        st = os.stat(path)
+    except EnvironmentError:
+        return None
+    return digest + ("|%d|%r" % (st.st_size, st.st_mtime)).encode('ascii')
+
+
+def install_is_current(digest):
+    # The previous install is current if the sentinel is at least as new as
+    # both the LaunchAgent and the script and it holds the expected digest.
+    try:
+        sentinel_mtime = os.stat(install_sentinel).st_mtime
+        if (os.stat(launch_agent_file).st_mtime > sentinel_mtime or
+                os.stat(log_script_file).st_mtime > sentinel_mtime):
+            return False
+        with open(install_sentinel, 'rb') as fp:
+            return fp.read() == digest
+    except EnvironmentError:
+        return False
 
-else:
-    print("Existing LaunchAgent matches master. Continuing.")
 
 #-----------------------
 # Create the script
 #-----------------------
 
-log_script = ("""
+# The script is kept as bytes so that it can be compared against and written
+# to the raw file without going through a text encoding layer.
+log_script = (b"""
 #!/System/Library/Frameworks/Python.framework/Versions/Current/Resources/Python.app/Contents/MacOS/Python
 
+import os
 import re
+import time
+import codecs
+import ctypes
 import objc
 import Cocoa
-import subprocess
 # Limit Foundation and AppKit imports to speed up loading.
 from Foundation import (
-    NSLog,
-    NSMutableArray,
+    NSIndexSet,
     NSObject,
     NSString,
     NSTimer,
-    NSUTF8StringEncoding,
 )
 from AppKit import (
     NSAnimationContext,
@@ -124,7 +207,6 @@ from AppKit import (
     NSButton,
     NSCenterTextAlignment,
     NSColor,
-    NSFileHandle,
     NSFont,
     NSLayoutConstraintOrientationVertical,
     NSLeftTextAlignment,
@@ -155,6 +237,71 @@ from SystemConfiguration import (
 )
 
 from PyObjCTools import AppHelper
+try:
+    # Only available with newer versions of PyObjC. Without it, the log is
+    # read on the main thread by the refresh timer instead.
+    import libdispatch
+except ImportError:
+    libdispatch = None
+
+# Constants from <libproc.h> and <sys/sysctl.h>
+PROC_ALL_PIDS = 1
+PROC_PIDPATHINFO_MAXSIZE = 4096
+CTL_KERN = 1
+KERN_ARGMAX = 8
+KERN_PROCARGS2 = 49
+
+# libproc and sysctl are used to list running processes without having to
+# spawn pgrep every time the window refreshes. Both are part of libSystem.
+libsystem = ctypes.CDLL("/usr/lib/libSystem.B.dylib", use_errno=True)
+libsystem.proc_listpids.argtypes = [
+    ctypes.c_uint32, ctypes.c_uint32, ctypes.c_void_p, ctypes.c_int]
+libsystem.proc_pidpath.argtypes = [
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_uint32]
+libsystem.sysctl.argtypes = [
+    ctypes.POINTER(ctypes.c_int), ctypes.c_uint, ctypes.c_void_p,
+    ctypes.POINTER(ctypes.c_size_t), ctypes.c_void_p, ctypes.c_size_t]
+
+
+def list_pids():
+    # Returns the pids of all running processes.
+    size = libsystem.proc_listpids(PROC_ALL_PIDS, 0, None, 0)
+    if size <= 0:
+        return []
+    # Leave room for any processes started since the size was returned.
+    pids = (ctypes.c_int * (size // ctypes.sizeof(ctypes.c_int) + 64))()
+    size = libsystem.proc_listpids(
+        PROC_ALL_PIDS, 0, pids, ctypes.sizeof(pids))
+    return sorted(
+        pid for pid in pids[:size // ctypes.sizeof(ctypes.c_int)] if pid)
+
+
+def pid_path(pid):
+    # Returns the path to the executable of a process, or None.
+    path = ctypes.create_string_buffer(PROC_PIDPATHINFO_MAXSIZE)
+    if libsystem.proc_pidpath(pid, path, ctypes.sizeof(path)) <= 0:
+        return None
+    return path.value
+
+
+def pid_arguments(pid):
+    # Returns the command line of a process, or None.
+    mib = (ctypes.c_int * 2)(CTL_KERN, KERN_ARGMAX)
+    argmax = ctypes.c_int()
+    size = ctypes.c_size_t(ctypes.sizeof(argmax))
+    if libsystem.sysctl(mib, 2, ctypes.byref(argmax), size, None, 0):
+        return None
+    mib = (ctypes.c_int * 3)(CTL_KERN, KERN_PROCARGS2, pid)
+    procargs = ctypes.create_string_buffer(argmax.value)
+    size = ctypes.c_size_t(argmax.value)
+    if libsystem.sysctl(mib, 3, procargs, size, None, 0):
+        return None
+    # The buffer holds argc, the executable path, some padding, and then
+    # the arguments followed by the environment.
+    argc = ctypes.c_int.from_buffer(procargs).value
+    parts = [part for part in procargs.raw[4:size.value].split(b"\\0")
+             if part]
+    return b" ".join(parts[1:argc + 1])
 
 
 class JamfLogButton(NSButton):
@@ -223,8 +370,7 @@ class JamfLogTextField(NSTextField):
             return None
 
         # Set defaults.
-        self.setStringValue_(
-            NSString.stringWithString_(text))
+        self.setStringValue_(text)
         self.setBezeled_(False)
         self.setDrawsBackground_(False)
         self.setSelectable_(False)
@@ -242,7 +388,7 @@ class JamfLogTextView(NSTextView):
             return None
 
         # Set defaults.
-        self.setString_(NSString.stringWithString_(text))
+        self.setString_(text)
         self.setDrawsBackground_(True)
         self.setSelectable_(False)
         self.setFont_(NSFont.userFixedPitchFontOfSize_(12))
@@ -258,94 +404,90 @@ class JamfLogSource(NSObject):
     # Line breaks are assumed to be LF, and partial lines from incremental
     # reading is handled.
 
-    log_file_data = NSMutableArray.alloc().init()
-    log_file_color = NSMutableArray.alloc().init()
     last_line_is_partial = False
+    # Look up colors by name rather than asking NSColor for them every line.
+    color_map = {
+        u"black": NSColor.blackColor(),
+        u"blue": NSColor.blueColor(),
+        u"brown": NSColor.brownColor(),
+        u"cyan": NSColor.cyanColor(),
+        u"darkgray": NSColor.darkGrayColor(),
+        u"gray": NSColor.grayColor(),
+        u"green": NSColor.greenColor(),
+        u"lightgray": NSColor.lightGrayColor(),
+        u"magenta": NSColor.magentaColor(),
+        u"orange": NSColor.orangeColor(),
+        u"purple": NSColor.purpleColor(),
+        u"red": NSColor.redColor(),
+        # White text is unreadable on the table, so use light gray.
+        u"white": NSColor.lightGrayColor(),
+        u"yellow": NSColor.yellowColor(),
+    }
+    line_attr_re = re.compile(r"^%\\{([^}]*)\\}(.*)$", re.DOTALL)
+
+    def init(self):
+        # Call the super class (NSObject)
+        self = objc.super(JamfLogSource, self).init()
+        if self is None:
+            return None
+
+        # Each instance gets its own lines. Plain Python lists avoid a round
+        # trip through the Objective-C runtime for every line added. PyObjC
+        # bridges single rows for the table view.
+        self.log_file_data = []
+        self.log_file_color = []
+        self.last_line_is_partial = False
+        # The same font is used for every row, so only create it once.
+        self.fixed_font = NSFont.userFixedPitchFontOfSize_(12)
+
+        return self
 
     def addLine_partial_(self, line, isPartial):
         if self.last_line_is_partial:
             new_line, color = self.parseLineAttr_(
-                self.log_file_data.lastObject() + line)
-            self.log_file_data.removeLastObject()
-            self.log_file_color.removeLastObject()
-            self.log_file_data.addObject_(new_line)
-            self.log_file_color.addObject_(color)
+                self.log_file_data[-1] + line)
+            self.log_file_data[-1] = new_line
+            self.log_file_color[-1] = color
         else:
             new_line, color = self.parseLineAttr_(line)
-            self.log_file_data.addObject_(new_line)
-            self.log_file_color.addObject_(color)
+            self.log_file_data.append(new_line)
+            self.log_file_color.append(color)
         self.last_line_is_partial = isPartial
 
     def nsColorForColor_(self, color):
-        if color == u"black":
-            return NSColor.blackColor()
-        elif color == u"blue":
-            return NSColor.blueColor()
-        elif color == u"brown":
-            return NSColor.brownColor()
-        elif color == u"cyan":
-            return NSColor.cyanColor()
-        elif color == u"darkgray":
-            return NSColor.darkGrayColor()
-        elif color == u"gray":
-            return NSColor.grayColor()
-        elif color == u"green":
-            return NSColor.greenColor()
-        elif color == u"lightgray":
-            return NSColor.lightGrayColor()
-        elif color == u"magenta":
-            return NSColor.magentaColor()
-        elif color == u"orange":
-            return NSColor.orangeColor()
-        elif color == u"purple":
-            return NSColor.purpleColor()
-        elif color == u"red":
-            return NSColor.redColor()
-        elif color == u"white":
-            return NSColor.lightGrayColor()
-            #return NSColor.whiteColor()
-        elif color == u"yellow":
-            return NSColor.yellowColor()
-        else:
-            return NSColor.blackColor()
+        return self.color_map.get(color, self.color_map[u"black"])
 
     def parseLineAttr_(self, line):
-        if line.startswith(u"%{") and u"}" in line:
-            attrStr, _, rest = line[2:].partition(u"}")
-            NSLog(u"attrStr = %@", repr(attrStr))
-            color = NSColor.blackColor()
-            for attr in [x.strip() for x in attrStr.split(u",")]:
-                NSLog(u"attr = %@", repr(attr))
-                if u"=" in attr:
-                    key, value = [x.strip().lower() for x in attr.split(u"=", 1)]
-                    NSLog(u"key = %@, value = %@", repr(key), repr(value))
-                    if key == u"color":
-                        color = self.nsColorForColor_(value)
-                    else:
-                        NSLog(u"Unknown attribute key: %@", repr(key))
-                else:
-                    NSLog(u"Unknown attribute: %@", repr(attr))
-            return rest, color
-        else:
-            return line, NSColor.blackColor()
+        # Lines may start with attributes, e.g. "%{color=red}Some text".
+        match = self.line_attr_re.match(line)
+        if match is None:
+            return line, self.color_map[u"black"]
+        attrStr, rest = match.groups()
+        color = self.color_map[u"black"]
+        for attr in attrStr.split(u","):
+            key, separator, value = attr.partition(u"=")
+            if separator and key.strip().lower() == u"color":
+                color = self.nsColorForColor_(value.strip().lower())
+        return rest, color
 
     def removeAllLines(self):
-        self.log_file_data.removeAllObjects()
+        del self.log_file_data[:]
+        del self.log_file_color[:]
 
     def lineCount(self):
-        return self.log_file_data.count()
+        return len(self.log_file_data)
 
     def numberOfRowsInTableView_(self, tableView):
         return self.lineCount()
 
     def tableView_objectValueForTableColumn_row_(self, tableView, column, row):
-        return self.log_file_data.objectAtIndex_(row)
+        return self.log_file_data[row]
 
     def tableView_dataCellForTableColumn_row_(self, tableView, column, row):
         if column:
             cell = column.dataCell()
             cell.setTextColor_(self.log_file_color[row])
-            cell.setFont_(NSFont.userFixedPitchFontOfSize_(12))
+            cell.setFont_(self.fixed_font)
             return cell
         else:
             return None
@@ -369,7 +511,14 @@ class JamfLogWindow(NSWindowController):
     quit_app = JamfLogButton.alloc()
     refresh_view = JamfLogButton.alloc()
     window = NSWindow.alloc()
-    file_handle = None
+    log_fd = None
+    log_decoder = None
+    log_queue = None
+    log_source = None
+    # The computer name and network information change far less often than
+    # the log, so only refresh them every info_interval seconds.
+    info_interval = 30.0
+    info_refreshed = 0.0
     update_timer = None
 
     def showLogWindow_(self, title):
@@ -415,7 +564,7 @@ class JamfLogWindow(NSWindowController):
 
         # Add a column to the log_view NSTableView as it defaults to having
         # no columns.
-        self.column_identifier = NSString.stringWithString_(u"Column0")
+        self.column_identifier = u"Column0"
         self.table_column = NSTableColumn.alloc().initWithIdentifier_(
             self.column_identifier)
         self.table_column.setWidth_(text_rectangle.size.width)
@@ -430,7 +579,7 @@ class JamfLogWindow(NSWindowController):
         # Create buttons.
         self.refresh_view.initWithOptions(
             title="Refresh", position=(10.0, 40.0), key_equivalent="\\r",
-            target=self.key_window, action=self.refreshLog)
+            target=self.key_window, action=self.refreshAll)
         self.window.contentView().addSubview_(self.refresh_view)
         self.window.setDefaultButtonCell_(self.refresh_view)
 
@@ -439,14 +588,17 @@ class JamfLogWindow(NSWindowController):
             target=self.key_window, action='terminate:')
         self.window.contentView().addSubview_(self.quit_app)
 
+        # Font shared by the labels of the fields along the bottom.
+        label_font = NSFont.systemFontOfSize_(16)
+
         # Create computer name labels.
         self.computer_name_label.initWithOptions(
-            NSString.stringWithString_(u"Computer Name:"),
+            u"Computer Name:",
             ((200.0, 45.0), (200.0, 20.0)))
         self.window.contentView().addSubview_(self.computer_name_label)
 
         self.computer_name.initWithOptions(
-            NSString.stringWithString_(u"Unkown"),
+            u"Unkown",
             ((200.0, 15.0), (200.0, 30.0)))
         self.computer_name.setFont_(NSFont.boldSystemFontOfSize_(18))
         self.window.contentView().addSubview_(self.computer_name)
@@ -458,14 +610,14 @@ class JamfLogWindow(NSWindowController):
         # Create Jamf command fields. These will show a listing of commands
         # currently being executed by the jamf framework.
         self.jamf_command_label.initWithOptions(
-            NSString.stringWithString_(u"Jamf Processes:"),
+            u"Jamf Processes:",
             ((410.0, 15.0), (100.0, 50.0)))
-        self.jamf_command_label.setFont_(NSFont.systemFontOfSize_(16))
+        self.jamf_command_label.setFont_(label_font)
         self.jamf_command_label.setAlignment_(NSRightTextAlignment)
         self.window.contentView().addSubview_(self.jamf_command_label)
 
         self.jamf_command.initWithOptions(
-            NSString.stringWithString_(u"Unknown"), self.jamf_command_frame)
+            u"Unknown", self.jamf_command_frame)
         self.window.contentView().addSubview_(self.jamf_command)
 
         # Put the NSTextView into the NSScrollView
@@ -480,10 +632,10 @@ class JamfLogWindow(NSWindowController):
         # Create network fields. These will show a listing of currently
         # connected network devices.
         self.network_label.initWithOptions(
-            NSString.stringWithString_(u"Network Connections:"),
+            u"Network Connections:",
             ((self.network_frame.origin.x +
               self.network_frame.size.width + 10, 15.0), (100.0, 50.0)))
-        self.network_label.setFont_(NSFont.systemFontOfSize_(16))
+        self.network_label.setFont_(label_font)
         self.network_label.setAlignment_(NSRightTextAlignment)
         self.window.contentView().addSubview_(self.network_label)
 
@@ -493,7 +645,7 @@ class JamfLogWindow(NSWindowController):
                                          self.network_frame.origin.x)
 
         self.network.initWithOptions(
-            NSString.stringWithString_(u"Unknown"), self.network_frame)
+            u"Unknown", self.network_frame)
         self.window.contentView().addSubview_(self.network)
 
         # Put the NSTextView into the NSScrollView
@@ -525,8 +677,17 @@ class JamfLogWindow(NSWindowController):
         self.log_file_data.removeAllLines()
         self.log_view.setDataSource_(self.log_file_data)
         self.log_view.reloadData()
-        self.file_handle = NSFileHandle.fileHandleForReadingAtPath_(logFile)
+        # Read the log straight from a file descriptor. The incremental
+        # decoder holds on to any UTF-8 sequence split between two reads.
+        try:
+            self.log_fd = os.open(logFile, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.log_fd = None
+        self.log_decoder = codecs.getincrementaldecoder("utf-8")("replace")
         self.refreshLog()
+        # Watch the log for writes in the background when possible.
+        if libdispatch is not None and self.log_fd is not None:
+            self.startLogSource()
         # Kick off a timer that updates the log view periodically.
         self.update_timer = NSTimer.scheduledTimerWithTimeInterval_target_selector_userInfo_repeats_(
             5.00,
@@ -537,39 +698,108 @@ class JamfLogWindow(NSWindowController):
         )
 
     def stopWatching(self):
-        # Release the file handle and stop the update timer.
-        if self.file_handle is not None:
-            self.file_handle.closeFile()
-            self.file_handle = None
+        # Release the file descriptor and stop the update timer.
+        if self.log_source is not None:
+            # The source closes the file descriptor once it is cancelled.
+            libdispatch.dispatch_source_cancel(self.log_source)
+            self.log_source = None
+            self.log_fd = None
+        elif self.log_fd is not None:
+            os.close(self.log_fd)
+            self.log_fd = None
         if self.update_timer is not None:
             self.update_timer.invalidate()
             self.update_timer = None
 
+    def startLogSource(self):
+        # Read and decode new data on a background queue only when the log is
+        # written to, then hand the text to the main thread for display.
+        log_fd = self.log_fd
+        self.log_queue = libdispatch.dispatch_queue_create(
+            b"com.github.primalcurve.jamf_login_log", None)
+        self.log_source = libdispatch.dispatch_source_create(
+            libdispatch.DISPATCH_SOURCE_TYPE_VNODE, log_fd,
+            libdispatch.DISPATCH_VNODE_WRITE |
+            libdispatch.DISPATCH_VNODE_EXTEND,
+            self.log_queue)
+
+        def log_changed():
+            utf8string = self.readLogData()
+            if utf8string:
+                libdispatch.dispatch_async(
+                    libdispatch.dispatch_get_main_queue(),
+                    lambda: self.appendLogData_(utf8string))
+
+        libdispatch.dispatch_source_set_event_handler(
+            self.log_source, log_changed)
+        libdispatch.dispatch_source_set_cancel_handler(
+            self.log_source, lambda: os.close(log_fd))
+        libdispatch.dispatch_resume(self.log_source)
+
     def refreshLog(self):
-        # Check for new available data, read it, and scroll to the bottom.
-        data = self.file_handle.availableData()
-        if data.length():
-            utf8string = NSString.alloc().initWithData_encoding_(
-                data,
-                NSUTF8StringEncoding
-            )
+        # Check for new available data, unless the log is being watched in
+        # the background, and refresh the other fields.
+        if self.log_source is None:
+            self.appendLogData_(self.readLogData())
+        self.jamf_command.setString_(self.get_jamf_command())
+        self.jamf_command.scrollToBeginningOfDocument_(self.jamf_command)
+        self.jamf_command.displayIfNeeded()
+        now = time.time()
+        if now - self.info_refreshed < self.info_interval:
+            return
+        self.info_refreshed = now
+        self.computer_name.setStringValue_(self.get_sc_computername())
+        self.computer_name.displayIfNeeded()
+        self.network.setString_(self.get_network_info())
+        self.network.scrollToBeginningOfDocument_(self.network)
+        self.network.displayIfNeeded()
+
+    def refreshAll(self):
+        # The Refresh button always updates every field, bypassing the
+        # info_interval throttle that only the update timer needs.
+        self.info_refreshed = 0.0
+        self.refreshLog()
+
+    def appendLogData_(self, utf8string):
+        # Add new log data to the table and scroll to the bottom.
+        if utf8string:
+            # If the last line was partial, the new data is appended to it.
+            if self.log_file_data.last_line_is_partial:
+                changed_row = self.log_file_data.lineCount() - 1
+            else:
+                changed_row = None
             for line in utf8string.splitlines(True):
                 if line.endswith(u"\\n"):
                     self.log_file_data.addLine_partial_(
                         line.rstrip(u"\\n"), False)
                 else:
                     self.log_file_data.addLine_partial_(line, True)
-            self.log_view.reloadData()
+            # The log is only ever appended to, so rather than reloading the
+            # whole table, only redraw the row that changed and tell the
+            # table about the new rows.
+            if changed_row is not None:
+                self.log_view.reloadDataForRowIndexes_columnIndexes_(
+                    NSIndexSet.indexSetWithIndex_(changed_row),
+                    NSIndexSet.indexSetWithIndex_(0))
+            self.log_view.noteNumberOfRowsChanged()
             self.log_view.scrollRowToVisible_(
                 self.log_file_data.lineCount() - 1)
-        self.computer_name.setStringValue_(self.get_sc_computername())
-        self.computer_name.displayIfNeeded()
-        self.jamf_command.setString_(self.get_jamf_command())
-        self.jamf_command.scrollToBeginningOfDocument_(self.jamf_command)
-        self.jamf_command.displayIfNeeded()
-        self.network.setString_(self.get_network_info())
-        self.network.scrollToBeginningOfDocument_(self.network)
-        self.network.displayIfNeeded()
+
+    def readLogData(self):
+        # Read everything added to the log since the last read in 64 KiB
+        # chunks, and return it as text.
+        if self.log_fd is None:
+            return u""
+        chunks = []
+        while True:
+            try:
+                chunk = os.read(self.log_fd, 65536)
+            except OSError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return self.log_decoder.decode(b"".join(chunks))
 
     def get_sc_computername(self):
         # Gets the computer name from SystemConfiguration
@@ -579,7 +809,7 @@ class JamfLogWindow(NSWindowController):
                 "System")["System"]["ComputerName"]
         except:
             # Return False for any exception.
-            return NSString.stringWithString_("Unknown")
+            return "Unknown"
 
     def get_network_info(self):
         # Gets network information from SystemConfiguration
@@ -601,35 +831,42 @@ class JamfLogWindow(NSWindowController):
             # Weak references break this. So I have to associate this method
             # with a Python object.
             copiedInterfaces = SCNetworkInterfaceCopyAll()
-            for interface in copiedInterfaces:
-                bsdName = SCNetworkInterfaceGetBSDName(interface)
-                try:
-                    [i.update(
-                        name=SCNetworkInterfaceGetLocalizedDisplayName(interface),
-                        mac=SCNetworkInterfaceGetHardwareAddressString(interface))
-                     for i in connectedDevices if i["interface"] == bsdName]
-                except TypeError:
-                    pass
-
-            return NSString.stringWithString_(
-                "\\n".join(
-                    ["%s\\t%s\\t%s (%s)" %
-                     (i["mac"], i["address"][0], i["name"], i["interface"])
-                     for i in connectedDevices]))
+            # Map each BSD name to its display name and MAC address, then
+            # look up each connected device in a single pass.
+            interfaceInfo = {
+                SCNetworkInterfaceGetBSDName(interface): (
+                    SCNetworkInterfaceGetLocalizedDisplayName(interface),
+                    SCNetworkInterfaceGetHardwareAddressString(interface))
+                for interface in copiedInterfaces}
+            for device in connectedDevices:
+                info = interfaceInfo.get(device["interface"])
+                if info is not None:
+                    device["name"], device["mac"] = info
+
+            return "\\n".join(
+                "%s\\t%s\\t%s (%s)" %
+                (i["mac"], i["address"][0], i["name"], i["interface"])
+                for i in connectedDevices)
 
         except KeyError:
             # Don't want a blanket exception.
-            return NSString.stringWithString_("Unknown")
+            return "Unknown"
 
     def get_jamf_command(self):
-        # Gets the computer name from SystemConfiguration
+        # Gets the running jamf processes, like "pgrep -fl jamf" would.
         try:
-            return NSString.stringWithString_(
-                subprocess.check_output(
-                    ["pgrep", "-fl", "jamf"]))
+            jamf_commands = list()
+            for pid in list_pids():
+                path = pid_path(pid)
+                if path is None or b"jamf" not in path:
+                    continue
+                command = pid_arguments(pid) or path
+                jamf_commands.append(
+                    u"%d %s" % (pid, command.decode("utf-8", "replace")))
+            return u"\\n".join(jamf_commands)
         except:
             # Return False for any exception.
-            return NSString.stringWithString_("Unknown")
+            return "Unknown"
 
     def windowWillClose_(self, notification):
         # If main window is closed with close button, close the backdrop
@@ -677,17 +914,79 @@ if __name__ == '__main__':
     main()
 
 """)
+log_script_digest = hashlib.sha256(log_script).hexdigest().encode('ascii')
+
+#-----------------------
+# Create the LaunchAgent
+#-----------------------
+
+# Serialize the LaunchAgent once. Comparing the serialized bytes against the
+# raw contents of the existing file is far cheaper than parsing the existing
+# plist back into a dictionary, and it means an unchanged LaunchAgent is never
+# rewritten (which would otherwise cause macOS to re-notify the user).
+# launchd reads binary plists natively, and they are smaller and faster to
+# produce than XML.
+try:
+    launch_agent_bytes = plistlib.dumps(
+        launch_agent_dict, fmt=plistlib.FMT_BINARY)
+except AttributeError:
+    # Older versions of plistlib only have the string-based XML API.
+    launch_agent_bytes = plistlib.writePlistToString(launch_agent_dict)
+
+# If nothing has changed since the last install, skip checking the existing
+# LaunchAgent and script entirely.
+install_digest = hashlib.sha256(
+    launch_agent_bytes + log_script).hexdigest().encode('ascii')
+install_current = install_is_current(install_digest)
+# Set when either the LaunchAgent or the script is rewritten so that a loaded
+# LaunchAgent is properly booted out and restarted.
+agent_changed = False
+
+# Read the raw bytes of the existing LaunchAgent, if there is one.
+if install_current:
+    existing_launch_agent = launch_agent_bytes
+    print("LaunchAgent matches the last install. Continuing.")
+else:
+    existing_launch_agent = read_file(
+        launch_agent_file, len(launch_agent_bytes))
+    if existing_launch_agent is not None:
+        print("LaunchAgent already exists. Checking it against master LD.")
+
+# If the LaunchAgents do not match, then we will re-write it.
+if existing_launch_agent != launch_agent_bytes:
+    agent_changed = True
+    print("LaunchAgent does not exist or does not match master. Creating.")
+    # Write the LaunchAgent:
+    write_file(launch_agent_file, launch_agent_bytes, 0o644)
+
+    # Make sure the LaunchAgent has the correct ownership and permissions:
+    set_permissions(launch_agent_file, 0o644)
 
-# If script already exists, then check its contents against the script above.
-if os.path.exists(log_script_file):
-    with open(log_script_file, 'r') as fp:
-        existing_script = fp.read()
-    print("Script exists. Checking its contents against master script.")
 else:
-    # We need to set existing_script to something, so we will set it to None
-    # so that it does not match below.
-    existing_script = None
-    print("Script does not exist. Will create.")
+    print("Existing LaunchAgent matches master. Continuing.")
+
+#-----------------------
+# Write the script
+#-----------------------
+
+# The digest of the script is stored on the file itself when it is written,
+# along with the size and mtime of the file at that point. If all of them
+# still match, there is no need to read the file at all.
+script_stamp_current = script_stamp(log_script_file, log_script_digest)
+if install_current:
+    existing_script = log_script
+    print("Script matches the last install.")
+elif (script_stamp_current is not None and
+        get_xattr(log_script_file, log_script_xattr) == script_stamp_current):
+    existing_script = log_script
+    print("Script digest matches master script.")
+# If script already exists and is the right size, then check its contents
+# against the script above. Otherwise existing_script is None so that it does
+# not match below.
+else:
+    existing_script = read_file(log_script_file, len(log_script))
+    if existing_script is not None:
+        print("Script exists. Checking its contents against master script.")
 
 # If the script doesn't match or doesn't exist, then we will write it anew.
 if existing_script != log_script:
@@ -696,35 +995,61 @@ if existing_script != log_script:
     if not os.path.exists(os.path.dirname(log_script_file)):
         os.makedirs(os.path.dirname(log_script_file), 0o700)
     # Write the above script to a file.
-    with open(log_script_file, "w") as file:
-        file.write(log_script)
+    write_file(log_script_file, log_script, 0o755)
+    set_xattr(log_script_file, log_script_xattr,
+              script_stamp(log_script_file, log_script_digest))
+    agent_changed = True
 
     #-----------------------
     # fix permissions on script
     #-----------------------
 
-    os.lchown(log_script_file, uid, gid)
-    os.chmod(launch_agent_file, 0o755)
+    set_permissions(log_script_file, 0o755)
 
     print("New script file written.")
 
 else:
     print("Script file matches master. No need to update. Exiting.")
 
+# Record the successful install so that the next run can skip the checks.
+if not install_current:
+    write_file(install_sentinel, install_digest, 0o600)
+
 # Start the LaunchAgent:
+# Check whether the LaunchAgent is already loaded. If it is and nothing has
+# changed, there is nothing left to do.
+service_target = ("loginwindow/" + launch_agent_label)
+with open(os.devnull, 'wb') as devnull:
+    agent_loaded = subprocess.call(
+        [LAUNCHCTL, "print", service_target],
+        stdout=devnull, stderr=devnull) == 0
+
 # Created the launchctl commands in a list.
-launchctl_list = [
-    [LAUNCHCTL, "bootstrap", "loginwindow", launch_agent_file],
-    [LAUNCHCTL, "enable", "loginwindow/" + launch_agent_label],
-    [LAUNCHCTL, "kickstart", "-k", "loginwindow/" + launch_agent_label]]
+launchctl_list = []
+if agent_loaded and not agent_changed:
+    print("LaunchAgent is already loaded and matches master. Exiting.")
+else:
+    if agent_loaded:
+        # Boot out the old LaunchAgent so that the new one is loaded.
+        launchctl_list.append([LAUNCHCTL, "bootout", service_target])
+    launchctl_list.extend([
+        [LAUNCHCTL, "bootstrap", "loginwindow", launch_agent_file],
+        [LAUNCHCTL, "enable", service_target],
+        [LAUNCHCTL, "kickstart", "-k", service_target]])
 
 # Run the launchctl commands, but don't pipe their output as that will create
-# a lot of noise in the logs.
-for cmd in launchctl_list:
-    try:
-        subprocess.check_call(cmd)
-        print(" ".join(cmd) + " - succeeded.")
-    except subprocess.CalledProcessError:
-        print(" ".join(cmd) + " - did not succeed.")
+# a lot of noise in the logs. All of the commands are run from a single shell
+# rather than spawning each one from Python. Each command still runs whether
+# or not the previous one succeeded, and reports its own result.
+launchctl_script = "\n".join(
+    "%s && echo %s || echo %s" % (
+        " ".join(quote(arg) for arg in cmd),
+        quote(" ".join(cmd) + " - succeeded."),
+        quote(" ".join(cmd) + " - did not succeed."))
+    for cmd in launchctl_list)
+if launchctl_list:
+    # Make sure our own output is written before the shell's.
+    sys.stdout.flush()
+    subprocess.call(["/bin/sh", "-c", launchctl_script])
 
 sys.exit(0)
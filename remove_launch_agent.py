@@ -28,18 +28,32 @@ limitations under the License.
 # Remove any other detected paths to prevent issues with incompatible versions
 # of PyObjC or other modules.
 import sys
-for index, path in enumerate(sys.path):
-    if path[1:6] == "Users" or path[1:8] == "Library":
-        sys.path.pop(index)
+
+
+def _is_ignored_path(path):
+    # Paths under /Users or /Library are not used.
+    return path[1:6] == "Users" or path[1:8] == "Library"
+
+
+sys.path[:] = [path for path in sys.path if not _is_ignored_path(path)]
 
 import argparse
+import base64
+import concurrent.futures
 import datetime
+import functools
 import logging
-import logging.handlers
 import os
+import pickle
 import plistlib
-import re
+import shlex
 import subprocess
+try:
+    # lxml parses plists considerably faster than plistlib, but it is not part
+    # of the standard library. Fall back to plistlib without it.
+    from lxml import etree
+except ImportError:
+    etree = None
 
 
 ###############################################################################
@@ -51,6 +65,41 @@ import subprocess
 EPOCH_AS_FILETIME = 116444736000000000
 HUNDREDS_OF_NANOSECONDS = 10000000
 
+# dscl keys that are dropped by process_key_values. Both the raw keys from
+# dscl and their fixed case forms are listed so that ignored keys can be
+# skipped before doing any work on them.
+IGNORED_KEYS = frozenset([
+    "user_certificate", "cached_groups", "shadow_hash_data",
+    "cached_auth_policy", "password", "preserved_attributes",
+    "linked_identity", "account_policy_data", "mcx_settings",
+    "mcx_flags", "original_authentication_authority",
+    "apple_meta_node_location",
+    "dsAttrTypeStandard:UserCertificate", "dsAttrTypeNative:cached_groups",
+    "dsAttrTypeNative:ShadowHashData",
+    "dsAttrTypeNative:cached_auth_policy", "dsAttrTypeStandard:Password",
+    "dsAttrTypeNative:preserved_attributes",
+    "dsAttrTypeNative:LinkedIdentity", "dsAttrTypeNative:accountPolicyData",
+    "dsAttrTypeStandard:MCXSettings", "dsAttrTypeStandard:MCXFlags",
+    "dsAttrTypeStandard:OriginalAuthenticationAuthority",
+    "dsAttrTypeStandard:AppleMetaNodeLocation"])
+
+# Shortnames that get_mobile_users never returns.
+IGNORED_USERS = frozenset(["admin", "root", "daemon", "guest", "nobody"])
+
+# Fixed case keys that get special handling in process_key_values.
+LIST_KEYS = frozenset()
+LOWER_CASE_KEYS = frozenset(["uid"])
+TITLE_CASE_KEYS = frozenset(["display_name", "first_name", "given_name"])
+HOME_FOLDER_KEYS = frozenset(["smb_home", "original_smb_home"])
+WINDOWS_TIMESTAMP_KEYS = frozenset([
+    "smb_password_last_set", "bad_password_time", "last_logon",
+    "last_logon_timestamp", ])
+
+# Characters used by fix_case to find word boundaries.
+UPPER_CASE = frozenset("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+LOWER_CASE = frozenset("abcdefghijklmnopqrstuvwxyz")
+LOWER_CASE_AND_DIGITS = LOWER_CASE | frozenset("0123456789")
+
 # Binary paths
 # Set global constants
 LAUNCHCTL = ("/bin/launchctl")
@@ -61,6 +110,9 @@ R_DOMAIN = "com.github.primalcurve"
 LIBRARY_SUPPORT = ("/Library/Application Support/")
 LIBRARY_LOGS = ("/Library/Logs/")
 LIBRARY_LAUNCHAGENTS = ("/Library/LaunchAgents/")
+# Directory Services keeps one file per local user here. Its modification time
+# changes whenever a user record is added, removed, or rewritten.
+DSLOCAL_USERS = ("/var/db/dslocal/nodes/Default/users")
 
 # Logging Config
 # This must happen within the global namespace to allow access to the logger
@@ -76,36 +128,73 @@ LOG_PARENT_DIR = os.path.join(
     LIBRARY_LOGS, R_DOMAIN, LONG_R_DOMAIN)
 SCRIPT_CACHE = os.path.join(
     LIBRARY_SUPPORT, R_DOMAIN, LONG_R_DOMAIN)
-### Make the directories if they do not exist.
-if not os.path.exists(LOG_PARENT_DIR):
-    os.makedirs(LOG_PARENT_DIR)
-if not os.path.exists(SCRIPT_CACHE):
-    os.makedirs(SCRIPT_CACHE)
 ### Create the name of the log file for the logger.
 LOG_FILE = os.path.join(LOG_PARENT_DIR, LONG_R_DOMAIN + ".log")
+### Rotate the log file once it reaches 5 MB, keeping 5 old copies.
+LOG_MAX_BYTES = 5 * 1024 * 1024
+LOG_BACKUP_COUNT = 5
+### Cache of the users returned by get_mobile_users.
+USER_CACHE_FILE = os.path.join(SCRIPT_CACHE, "users.pickle")
 
-## Configure the logger object.
-### logging Formatters
-easy_formatter = logging.Formatter("%(message)s")
-file_formatter = logging.Formatter(
-    "%(asctime)s|func:%(funcName)s|" +
-    "line:%(lineno)s|%(message)s")
-### Defining the different Log StreamHandlers
-log_stderr = logging.StreamHandler()
-#### Rotate the log file every 1 day 5 times before deleting.
-log_logfile = logging.handlers.TimedRotatingFileHandler(
-    LOG_FILE, when="D", interval=1, backupCount=5)
-### Defining different log levels for each StreamHandler
-#### Only log INFO and above logging events to stderr
-log_stderr.setLevel(logging.INFO)
-#### Log all messages with DEBUG and above to the logfile.
-log_logfile.setLevel(logging.DEBUG)
-### Add formatters to logging Handlers.
-log_stderr.setFormatter(easy_formatter)
-log_logfile.setFormatter(file_formatter)
-### Add all of the handlers to this logging instance:
-logger.addHandler(log_stderr)
-logger.addHandler(log_logfile)
+
+def setup_logging():
+    """Creates the program folders and attaches the handlers to the logger.
+    This is deferred until main() so that nothing touches the filesystem
+    when the arguments cannot be parsed or only --help is requested.
+    Args:
+        None
+    Returns:
+        None
+    """
+    ### Make the directories if they do not exist.
+    os.makedirs(LOG_PARENT_DIR, exist_ok=True)
+    os.makedirs(SCRIPT_CACHE, exist_ok=True)
+
+    ## Configure the logger object.
+    ### logging Formatters
+    easy_formatter = logging.Formatter("%(message)s")
+    file_formatter = logging.Formatter(
+        "%(asctime)s|func:%(funcName)s|" +
+        "line:%(lineno)s|%(message)s")
+    ### Defining the different Log StreamHandlers
+    log_stderr = logging.StreamHandler()
+    #### Rotate the log file once per run rather than checking on every
+    #### emit, as this script finishes in seconds.
+    rotate_log_file()
+    log_logfile = logging.FileHandler(LOG_FILE)
+    ### Defining different log levels for each StreamHandler
+    #### Only log INFO and above logging events to stderr
+    log_stderr.setLevel(logging.INFO)
+    #### Log all messages with DEBUG and above to the logfile.
+    log_logfile.setLevel(logging.DEBUG)
+    ### Add formatters to logging Handlers.
+    log_stderr.setFormatter(easy_formatter)
+    log_logfile.setFormatter(file_formatter)
+    ### Add all of the handlers to this logging instance:
+    logger.addHandler(log_stderr)
+    logger.addHandler(log_logfile)
+
+
+def rotate_log_file():
+    """Moves LOG_FILE to LOG_FILE.1 once it grows past LOG_MAX_BYTES,
+    shifting older copies up and dropping any past LOG_BACKUP_COUNT.
+    Args:
+        None
+    Returns:
+        None
+    """
+    try:
+        if os.stat(LOG_FILE).st_size < LOG_MAX_BYTES:
+            return
+    except FileNotFoundError:
+        return
+    for index in range(LOG_BACKUP_COUNT - 1, 0, -1):
+        try:
+            os.replace("%s.%d" % (LOG_FILE, index),
+                       "%s.%d" % (LOG_FILE, index + 1))
+        except FileNotFoundError:
+            pass
+    os.replace(LOG_FILE, LOG_FILE + ".1")
 
 
 ###############################################################################
@@ -119,30 +208,45 @@ class LocalUser(object):
     """Object that provides attributes and methods for working with user
     accounts on machines.
     """
-    def __init__(self, shortname):
+    def __init__(self, shortname, record=None, skip_dscl=False):
         """Basic Initialization. Nothing runs until start_script is called.
+        If record is given, it is used instead of reading the user's record
+        from dscl. If skip_dscl is True, only the shortname is set.
         """
         self.shortname = shortname
-        dscl_cmd = ["/usr/bin/dscl", "-plist", ".",
-                    "-read", "/Users/" + self.shortname]
-        self._dscl_plist = self._run_dscl(dscl_cmd)
-        if self._dscl_plist:
-            self._populate_user_info()
+        if skip_dscl:
+            return
+        if record is None:
+            dscl_cmd = ["/usr/bin/dscl", "-plist", ".",
+                        "-read", "/Users/" + self.shortname]
+            self._dscl_plist = self._run_dscl(dscl_cmd)
+            if self._dscl_plist:
+                record = plist_from_bytes(self._dscl_plist)
+        if record:
+            self._populate_user_info(record)
+
+    def __getstate__(self):
+        # Leave the raw dscl record out when caching users. It is large and
+        # includes data such as password hashes that should not be copied.
+        return dict((key, value) for key, value in self.__dict__.items()
+                    if not key.startswith("_dscl"))
 
     def _run_dscl(self, dscl_cmd):
+        # Not closing fds lets subprocess use posix_spawn for this call.
         try:
-            return subprocess.check_output(dscl_cmd)
+            return subprocess.check_output(dscl_cmd, close_fds=False)
         except subprocess.CalledProcessError:
             return False
 
-    def _populate_user_info(self):
-        self._dscl_dict = plistlib.readPlistFromString(self._dscl_plist)
-        for key, value in self._dscl_dict.iteritems():
+    def _populate_user_info(self, record):
+        self._dscl_dict = record
+        for key, value in self._dscl_dict.items():
             process_key_values(self, key, value)
 
     def run_as_me(self, cmd, get_output=True):
-        logger.debug("Running requested command as %s: %s" %
-                     (self.real_name, " ".join(cmd)))
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Running requested command as %s: %s",
+                         self.real_name, " ".join(cmd))
         if get_output:
             return self._run_as_me(cmd)
         else:
@@ -155,22 +259,22 @@ class LocalUser(object):
                 return True
 
     def _run_as_me(self, cmd):
-        # Run command as the user using subprocess's preexec_fun method.
+        # Run command as the user. Passing user and group (Python 3.9+) has
+        # subprocess switch ids in C between fork and exec, rather than
+        # calling back into Python through a preexec_fn. subprocess never uses
+        # posix_spawn when user or group is given, so this call still forks
+        # and execs. Popen raises OSError, not CalledProcessError, when the
+        # command cannot be started.
         try:
-            return subprocess.Popen(
+            process = subprocess.Popen(
                 cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                preexec_fn=self._demote()).communicate()
-        except subprocess.CalledProcessError:
+                user=self.unique_id, group=self.primary_group_id,
+                close_fds=False)
+            return process.communicate()
+        except OSError as e:
+            logger.debug("Caught OSError: %s", e)
             return (False, False)
 
-    def _demote(self):
-        def result():
-            logger.debug("Starting Demotion")
-            os.setgid(self.primary_group_id)
-            os.setuid(self.unique_id)
-            logger.debug('Finished Demotion')
-        return result
-
 
 def process_key_values(instance_object, key, value):
     """Processes key/value pairs from class methods to clean them up
@@ -183,21 +287,12 @@ def process_key_values(instance_object, key, value):
     Returns:
         None: Instances are modified in place.
     """
-    logger.debug("Received raw key: " + key)
-    ignore_list = [
-        "user_certificate", "cached_groups", "shadow_hash_data",
-        "cached_auth_policy", "password", "preserved_attributes",
-        "linked_identity", "account_policy_data", "mcx_settings",
-        "mcx_flags", "original_authentication_authority",
-        "apple_meta_node_location"]
-    are_lists = []
-    lower_case = ["uid"]
-    title_case = [
-        "display_name", "first_name", "given_name"]
-    home_folders = ["smb_home", "original_smb_home"]
-    windows_timestamps = [
-        "smb_password_last_set", "bad_password_time", "last_logon",
-        "last_logon_timestamp", ]
+    # Some keys from dscl that have embedded images and other large
+    # chunks of data, and other keys we don't need. Skip them before doing
+    # anything else.
+    if key.startswith("dsAttrTypeNative:_writers_") or key in IGNORED_KEYS:
+        return
+    logger.debug("Received raw key: %s", key)
     # Convert pascalCase keys to pascal_case keys as these will be converted
     # into attributes.
     try:
@@ -213,7 +308,7 @@ def process_key_values(instance_object, key, value):
     elif key[:9] == "_writers_":
         return
     # Other keys we don't need.
-    elif key in ignore_list:
+    elif key in IGNORED_KEYS:
         return
 
     # Value Modification.
@@ -222,18 +317,17 @@ def process_key_values(instance_object, key, value):
         value = value[0]
 
     # Convert email addresses to lower_case.
-    if "@" in value or key in lower_case:
-        logger.debug("Converting %s to %s" % (value, value.lower()))
+    if "@" in value or key in LOWER_CASE_KEYS:
+        logger.debug("Converting %s to %s", value, value.lower())
         value = value.lower()
     # Convert names that may be in ALL CAPS to Title Case.
-    elif key in title_case:
-        logger.debug("Converting %s to %s" % (value, value.title()))
+    elif key in TITLE_CASE_KEYS:
+        logger.debug("Converting %s to %s", value, value.title())
         value = value.title()
     # Special case where multiple values will be returned with the same key.
-    elif key in are_lists:
+    elif key in LIST_KEYS:
         logger.debug(
-            "Appending list Attribute: %s with Value: %s" %
-            (key, str(value)))
+            "Appending list Attribute: %s with Value: %s", key, value)
         # Try to set the key directly,
         try:
             instance_object.__dict__[key].append(value)
@@ -244,52 +338,107 @@ def process_key_values(instance_object, key, value):
     # Specific keys:
     # Convert Windows timestamp to seconds since epoch
     # and then to a datetime object.
-    elif key in windows_timestamps:
+    elif key in WINDOWS_TIMESTAMP_KEYS:
         value = datetime.datetime.utcfromtimestamp(
             (int(value) - EPOCH_AS_FILETIME) / HUNDREDS_OF_NANOSECONDS)
-        logger.debug("Converted Windows time stamp to datetime: %s" % (value))
+        logger.debug("Converted Windows time stamp to datetime: %s", value)
     elif key == "member_of":
         value = [
             v.split("=", 1)[1].split(",", 1)[0] for v in value]
     # Convert SMBHome from Windows formatted paths to macOS formatted.
-    elif key in home_folders:
-        logger.debug("Converting %s to %s" % (value, smb_home_fix(value)))
-        value = smb_home_fix(value)
-    # Try to convert any possible date into a datetime object.
-    try:
-        value = datetime.datetime.strptime(value, "%Y-%m-%d")
-        logger.debug("Converted %s to datetime: %s" % (key, value))
-    except ValueError:
-        pass
-    except TypeError:
-        pass
-    # Try to convert any possible integer into an integer object.
-    try:
-        value = int(value)
-        logger.debug("Converted %s to integer: %s" % (key, value))
-    except ValueError:
-        pass
-    except TypeError:
-        pass
-    # Try to convert phone numbers to a more easily-read version.
-    try:
-        code, num = value.split("/")
-        value = ("(%s) %s" % (code, num))
-        logger.debug("Converted %s to phone number: %s" % (key, value))
-    except ValueError:
-        pass
-    except AttributeError:
-        pass
+    elif key in HOME_FOLDER_KEYS:
+        fixed_value = smb_home_fix(value)
+        logger.debug("Converting %s to %s", value, fixed_value)
+        value = fixed_value
+    # Only strings are converted below. Check what each string looks like
+    # first rather than trying every conversion and catching the failures.
+    if isinstance(value, str):
+        # Try to convert any possible date into a datetime object.
+        if value.count("-") == 2 and value[:4].isdecimal():
+            try:
+                value = datetime.datetime.strptime(value, "%Y-%m-%d")
+                logger.debug("Converted %s to datetime: %s", key, value)
+            except ValueError:
+                pass
+        # Convert any possible integer into an integer object.
+        elif value.isdecimal() or (
+                value[:1] in ("+", "-") and value[1:].isdecimal()):
+            value = int(value)
+            logger.debug("Converted %s to integer: %s", key, value)
+        # Convert phone numbers to a more easily-read version.
+        elif value.count("/") == 1:
+            code, _, num = value.partition("/")
+            value = ("(%s) %s" % (code, num))
+            logger.debug("Converted %s to phone number: %s", key, value)
     # Now that conversion is complete, add the value to the object.
-    logger.debug(
-        "Adding Attribute: %s with Value: %s" % (key, str(value)))
+    logger.debug("Adding Attribute: %s with Value: %s", key, value)
     instance_object.__dict__.update({key: value})
 
 
+@functools.lru_cache(maxsize=256)
 def fix_case(pascal_case):
-    # Use regex substitution to make pascalCase pascal_case
-    s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', pascal_case)
-    return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
+    # Make pascalCase pascal_case in a single pass. An underscore goes before
+    # any capital that starts a new word (followed by a lower case letter) or
+    # that follows a lower case letter or digit. There are only a handful of
+    # distinct keys across all users, so cache the results.
+    last = len(pascal_case) - 1
+    chars = []
+    for index, char in enumerate(pascal_case):
+        if index and char in UPPER_CASE and (
+                pascal_case[index - 1] in LOWER_CASE_AND_DIGITS or
+                (index < last and pascal_case[index + 1] in LOWER_CASE)):
+            chars.append("_")
+        chars.append(char)
+    return "".join(chars).lower()
+
+
+def plist_from_bytes(plist_bytes):
+    """Parses a plist into Python objects. lxml is used if it is available,
+    otherwise this falls back to plistlib. Binary plists always use plistlib.
+    Args:
+        (bytes) plist_bytes: Raw contents of a plist.
+    Returns:
+        (dict) The top level object of the plist. Usually a dict.
+    """
+    if etree is None or plist_bytes[:8] == b"bplist00":
+        return plistlib.loads(plist_bytes)
+    parser = etree.XMLParser(
+        resolve_entities=False, no_network=True, huge_tree=True)
+    root = etree.fromstring(plist_bytes, parser)
+    return _plist_element_value(_plist_children(root)[0])
+
+
+def _plist_children(element):
+    # Child elements of an lxml element, skipping comments and the like.
+    return [child for child in element if isinstance(child.tag, str)]
+
+
+def _plist_element_value(element):
+    # Converts a single plist element from lxml into its Python equivalent.
+    tag = element.tag
+    if tag == "dict":
+        children = _plist_children(element)
+        return dict(
+            (key.text or "", _plist_element_value(value))
+            for key, value in zip(children[::2], children[1::2]))
+    elif tag == "array":
+        return [_plist_element_value(c) for c in _plist_children(element)]
+    elif tag == "string":
+        return element.text or ""
+    elif tag == "integer":
+        return int(element.text)
+    elif tag == "real":
+        return float(element.text)
+    elif tag == "true":
+        return True
+    elif tag == "false":
+        return False
+    elif tag == "date":
+        return datetime.datetime.strptime(
+            element.text, "%Y-%m-%dT%H:%M:%SZ")
+    elif tag == "data":
+        return base64.b64decode(element.text or "")
+    raise ValueError("Unsupported plist element: " + str(tag))
 
 
 def smb_home_fix(smb_home):
@@ -297,6 +446,28 @@ def smb_home_fix(smb_home):
         "smb://" + "/".join([s for s in smb_home.split("\\") if s]).lower())
 
 
+def get_all_user_records():
+    """Return the records of all local users from a single dscl call
+    Args:
+        None
+    Returns:
+        (dict) Raw dscl records for every user, keyed by shortname
+    """
+    # Get plist from dscl. Not closing fds lets subprocess use posix_spawn.
+    dscl_cmd = ["/usr/bin/dscl", "-plist", ".", "-readall", "/Users"]
+    try:
+        cmd_out = subprocess.check_output(dscl_cmd, close_fds=False)
+    except subprocess.CalledProcessError:
+        return dict()
+
+    records = dict()
+    for record in plist_from_bytes(cmd_out):
+        names = record.get("dsAttrTypeStandard:RecordName")
+        if names:
+            records[names[0]] = record
+    return records
+
+
 def get_mobile_users():
     """Return a list of users in OD with OriginalNodeName
     Args:
@@ -304,18 +475,131 @@ def get_mobile_users():
     Returns:
         (list) All users in OD with OriginalNodeName
     """
-    # Get string from dscl.
-    dscl_cmd = ["/usr/bin/dscl", "-plist", ".",
-                "-list", "/Users", "OriginalNodeName"]
+    # Reuse the users from the last run if no user records have changed.
+    cache_key = get_user_cache_key()
+    users = load_user_cache(cache_key)
+    if users is not None:
+        return users
+
+    # Return list not including anyone in the explicit IGNORED_USERS set
+    users = [LocalUser(name, record=record)
+             for name, record in get_all_user_records().items()
+             if name not in IGNORED_USERS and
+             "dsAttrTypeStandard:OriginalNodeName" in record]
+    save_user_cache(cache_key, users)
+    return users
+
+
+def get_user_cache_key():
+    """Return a fingerprint of the local user records. This is poor-man's
+    cache invalidation: if the directory holding the records has not been
+    modified, then neither have the users.
+    Args:
+        None
+    Returns:
+        (tuple) Modification time and size of the users directory, or None
+                if it cannot be read.
+    """
     try:
-        cmd_out = subprocess.check_output(dscl_cmd).strip()
-    except subprocess.CalledProcessError:
-        cmd_out = ""
+        users_stat = os.stat(DSLOCAL_USERS)
+    except OSError:
+        return None
+    return (users_stat.st_mtime_ns, users_stat.st_size)
+
+
+def load_user_cache(cache_key):
+    """Return the cached users if they were cached under cache_key
+    Args:
+        (tuple) cache_key: Current result of get_user_cache_key.
+    Returns:
+        (list) Cached LocalUser objects, or None on a cache miss.
+    """
+    if cache_key is None:
+        return None
+    try:
+        with open(USER_CACHE_FILE, "rb") as cache_file:
+            cached_key, users = pickle.load(cache_file)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+            ImportError, IndexError, TypeError, ValueError):
+        return None
+    if cached_key != cache_key:
+        return None
+    logger.debug("Using cached users from: %s", USER_CACHE_FILE)
+    for user in users:
+        user._cached = True
+    return users
+
+
+def save_user_cache(cache_key, users):
+    """Cache users under cache_key. The cache is written to a temporary file
+    and then moved into place so that it is never read half-written.
+    Args:
+        (tuple) cache_key: Current result of get_user_cache_key.
+        (list) users: LocalUser objects to cache.
+    Returns:
+        None
+    """
+    if cache_key is None:
+        return
+    temp_file = USER_CACHE_FILE + ".tmp"
+    try:
+        fd = os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "wb") as cache_file:
+            pickle.dump((cache_key, users), cache_file,
+                        pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_file, USER_CACHE_FILE)
+    except (OSError, pickle.PicklingError) as e:
+        logger.debug("Could not cache users: %s", e)
 
-    # Return list not including anyone in the explicit ignored_users list
-    ignored_users = ["admin", "root", "daemon", "guest", "nobody"]
-    return [LocalUser(u.split(" ")[0]) for u in cmd_out.splitlines()
-            if u.split(" ")[0] not in ignored_users]
+
+def teardown_launch_agent(user, arguments):
+    """Stop, unload, disable and delete a user's LaunchAgent.
+    Args:
+        (LocalUser) user: User with service_target and launch_agent_file set.
+        (Namespace) arguments: Parsed arguments from get_arguments.
+    Returns:
+        None
+    """
+    # Read existing LaunchAgent. LaunchAgents are represented as plists in
+    # macOS. We will use plistlib to read it. This will convert the
+    # LaunchAgent into a Python dictionary.
+    logger.debug("Reading contents of : %s", user.launch_agent_file)
+    try:
+        with open(user.launch_agent_file, "rb") as la_file:
+            launch_agent_dict = plist_from_bytes(la_file.read())
+    except FileNotFoundError:
+        launch_agent_dict = dict()
+
+    # If the LaunchAgent is designed to run in the loginwindow domain,
+    # then we will make sure our service target is correct.
+    session_types = launch_agent_dict.get("LimitLoadToSessionType", [])
+    if "LoginWindow" in session_types:
+        logger.debug("Changing domain_target to loginwindow.")
+        user.service_target = ("loginwindow/" + arguments.agent_name)
+
+    # Tear down the LaunchAgent:
+    cmd_list = [[LAUNCHCTL, "kill", "-15", user.service_target],
+                [LAUNCHCTL, "bootout", user.service_target],
+                [LAUNCHCTL, "disable", user.service_target]]
+
+    # Run the launchctl commands, but discard their output as that will
+    # create a lot of noise in the logs. All three commands are run from a
+    # single shell, and each runs even if the previous one failed.
+    shell_cmd = "; ".join(
+        " ".join(shlex.quote(arg) for arg in cmd) for cmd in cmd_list)
+    logger.debug("Running: %s", shell_cmd)
+    try:
+        subprocess.run(
+            ["/bin/sh", "-c", shell_cmd], stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL, close_fds=False)
+    except OSError as e:
+        logger.debug("Caught OSError: %s", e)
+
+    logger.debug("Deleting: %s", user.launch_agent_file)
+    try:
+        os.unlink(user.launch_agent_file)
+    except FileNotFoundError:
+        pass
 
 
 def get_arguments():
@@ -330,9 +614,6 @@ def get_arguments():
                         help="Directory containing LaunchAgents")
     # Skip unknown arguments.
     arguments, _ = parser.parse_known_args()
-    logger.info(
-        "Parsed Parameters: agent-name: " + str(arguments.agent_name) +
-        " agent-directory: " + str(arguments.agent_directory))
     return arguments
 
 
@@ -345,10 +626,16 @@ def main():
     """Main function"""
     # Get argparse parameters.
     arguments = get_arguments()
+    setup_logging()
+    logger.info(
+        "Parsed Parameters: agent-name: %s agent-directory: %s",
+        arguments.agent_name, arguments.agent_directory)
 
     # Build launchctl targets (domain/service-targets) for the LaunchAgent
     if arguments.agent_domain.lower() == "system":
-        root_user = LocalUser("root")
+        # Only the launchctl targets are needed for the system domain, so
+        # skip reading root's record from dscl.
+        root_user = LocalUser("root", skip_dscl=True)
         root_user.domain_target = ("system")
         root_user.service_target = ("system/" + arguments.agent_name)
         root_user.launch_agent_file = os.path.join(
@@ -358,51 +645,22 @@ def main():
         mobile_users = get_mobile_users()
         for user in mobile_users:
             user.domain_target = (
-                arguments.agent_domain + "/" + user.unique_id)
+                arguments.agent_domain + "/" + str(user.unique_id))
             user.service_target = (
                 user.domain_target + "/" + arguments.agent_name)
             user.launch_agent_file = os.path.join(
                 user.nfs_home_directory, "Library/LaunchAgents/",
                 arguments.agent_name + ".plist")
 
-    for user in mobile_users:
-        # Read existing LaunchAgent. LaunchAgents are represented as plists in
-        # macOS. We will use plistlib to read it. This will convert the
-        # LaunchAgent into a Python dictionary.
-        if os.path.exists(user.launch_agent_file):
-            logger.debug("Reading contents of : " + user.launch_agent_file)
-            with open(user.launch_agent_file, "r") as la_file:
-                launch_agent_dict = plistlib.readPlist(la_file)
-        else:
-            launch_agent_dict = dict()
-
-        # If the LaunchAgent is designed to run in the loginwindow domain,
-        # then we will make sure our service target is correct.
-        session_types = launch_agent_dict.get("LimitLoadToSessionType", [])
-        if "LoginWindow" in session_types:
-            logger.debug("Changing domain_target to loginwindow.")
-            arguments.agent_domain = ("loginwindow")
-            user.service_target = ("loginwindow/" + arguments.agent_name)
-
-        # Tear down the LaunchAgent:
-        cmd_list = [[LAUNCHCTL, "kill", "-15", user.service_target],
-                    [LAUNCHCTL, "bootout", user.service_target],
-                    [LAUNCHCTL, "disable", user.service_target]]
-
-        # Run the launchctl commands, but don't pipe their output as that will
-        # create a lot of noise in the logs.
-        for cmd in cmd_list:
-            logger.debug("Running: " + str(cmd))
-            try:
-                subprocess.Popen(
-                    cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                ).communicate()
-            except subprocess.CalledProcessError as e:
-                logger.debug("Caught CalledProcessError: " + str(e))
-
-        if os.path.exists(user.launch_agent_file):
-            logger.debug("Deleting: " + str(user.launch_agent_file))
-            os.unlink(user.launch_agent_file)
+    # Each user's LaunchAgent is independent of the others, so tear them
+    # down concurrently. Almost all of the time is spent waiting on launchctl
+    # and the filesystem, which releases the GIL.
+    if mobile_users:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=min(32, len(mobile_users))) as executor:
+            list(executor.map(
+                lambda user: teardown_launch_agent(user, arguments),
+                mobile_users))
 
     logger.debug("Finished processing LaunchAgent removal.")
     sys.exit(0)